@@ -1,14 +1,16 @@
 # Arthur Jeannerot - May 2022
 
 import bql
+import numpy as np
 import pandas as pd
-from ipywidgets import VBox, HBox, HTML, Button, DatePicker, Dropdown, Text, Tab, Textarea, Box, Layout, Accordion, Label
+from ipywidgets import VBox, HBox, HTML, Button, DatePicker, Dropdown, Text, Tab, Textarea, Box, Layout, Accordion, Label, Play, IntSlider, jslink
 from datetime import date, datetime,timedelta
 from dateutil.relativedelta import relativedelta
 import ipydatagrid as ipdg
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from shared import RunGuard, RunCancelled, execute, get_scheduler, INTERACTIVE, BATCH, export_in_background, export_path, EXPORT_FORMATS
 
 
 bq = bql.Service()
@@ -31,6 +33,7 @@ app_des = '''
             <li>Select a start and end date using the date pickers <br></li>
             <li>Input currency code in the Currency field<br></li>
             <li>Hit the <span style="font-style:italic; font-weight:bold"><u>Get Data</u></span> button to generate the visualisation <br></li>
+            <li>Use the SX5E Screener tab to compare dividend futures with consensus for every member at once <br></li>
             </ul>
             <span style="font-weight:bold"> Submit Your Ideas for the Next Bite: </span>
             <li>bquant3@bloomberg.net<br></li>
@@ -43,9 +46,14 @@ app_des = '''
 class DividendApp(VBox):
 
 
-    def __init__(self, bq_serv = None):
+    def __init__(self, bq_serv = None, timeout = 60, retries = 2):
         super().__init__()
         self.bq = bq_serv
+        self.scheduler = get_scheduler(bq_serv) # Kernel-wide request queue shared with the other apps
+        self.timeout = timeout # Seconds to wait for each BQL request
+        self.retries = retries # Retries for each failed or timed out BQL request
+        self.runs = {'index' : RunGuard(), 'stock' : RunGuard(), 'screener' : RunGuard()} # Latest-wins run tracking for each tab
+        self.datasets = {} # DataFrames from the last completed run of each tab, for export
         self.widgets = {}
         self._build_view()
 
@@ -74,14 +82,29 @@ class DividendApp(VBox):
                          'ASDA Index' : 'SPX Index'}
 
 
+        # Index tab views: two-date curve snapshot, or the full daily term structure over the date range
+        idx_modes = {'Snapshot' : 'snapshot',
+                     'Term Structure History' : 'history'}
+
+
         settings = {'index_info' :  index_info,
-                    'index_mapping' : index_mapping}
+                    'index_mapping' : index_mapping,
+                    'idx_modes' : idx_modes}
 
 
         return settings
     
     
-    def get_idx_members(self):
+    def execute(self, req, token = None, priority = INTERACTIVE):
+        '''
+        Execute a BQL request through the shared scheduler with the app's timeout and retry settings, cancelling with the run's token
+        '''
+
+
+        return execute(self.scheduler, req, token = token, timeout = self.timeout, retries = self.retries, priority = priority)
+
+
+    def get_idx_members(self, token = None):
         '''
         Pull index members from BQL and turn them into a list to be used in user selection dropdown
         '''
@@ -95,7 +118,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(univ, fields)
-        res = bq.execute(req)
+        res = self.execute(req, token)
 
 
         tickers_df = pd.concat([fld.df()[fld.name] for fld in res], axis=1, sort=False)
@@ -117,6 +140,7 @@ class DividendApp(VBox):
         self.widgets['idx_ticker_label'] = Label(value = 'Index', layout = Layout(width = '100px'))
         self.widgets['idx_start_label'] = Label(value = 'Start Date', layout = Layout(width = '100px'))
         self.widgets['idx_end_label'] = Label(value = 'End Date', layout = Layout(width = '100px'))      
+        self.widgets['idx_mode_label'] = Label(value = 'View', layout = Layout(width = '100px'))
         
         
         # Default dates
@@ -127,6 +151,7 @@ class DividendApp(VBox):
         self.widgets['idx_ticker'] = Dropdown(options = app_settings['index_info'], value = 'DEDA Index', layout = Layout(width = '200px'))
         self.widgets['idx_start_dt'] = DatePicker(value = start_date, layout = Layout(width = '200px'))
         self.widgets['idx_end_dt'] = DatePicker(value = end_date, layout = Layout(width = '200px'))
+        self.widgets['idx_mode'] = Dropdown(options = app_settings['idx_modes'], value = 'snapshot', layout = Layout(width = '200px'))
         self.widgets['index_button'] = Button(description = 'Get Data', button_style = 'Primary')
         self.widgets['index_button'].on_click(self.index_run)
         self.widgets['idx_btn_view'] = HBox([self.widgets['index_button']], layout = {'margin': '20px 0px 20px 0px'})
@@ -136,6 +161,7 @@ class DividendApp(VBox):
         self.widgets['index_view'] = VBox([HBox([self.widgets['idx_ticker_label'], self.widgets['idx_ticker']]),
                                           HBox([self.widgets['idx_start_label'], self.widgets['idx_start_dt']]),
                                           HBox([ self.widgets['idx_end_label'], self.widgets['idx_end_dt']]),
+                                          HBox([self.widgets['idx_mode_label'], self.widgets['idx_mode']]),
                                           self.widgets['idx_btn_view']])
 
 
@@ -148,7 +174,8 @@ class DividendApp(VBox):
         
         
         # User input widgets
-        self.widgets['stock_ticker'] = Dropdown(options = list(self.get_idx_members().keys()), layout = Layout(width = '200px'))
+        self.idx_members = self.get_idx_members() # Pulled once and reused for chart titles
+        self.widgets['stock_ticker'] = Dropdown(options = list(self.idx_members.keys()), layout = Layout(width = '200px'))
         self.widgets['stock_start_dt'] = DatePicker(value=start_date, layout = Layout(width = '200px'))
         self.widgets['stock_end_dt'] = DatePicker(value=end_date, layout = Layout(width = '200px'))
         self.widgets['stock_currency'] = Text(value='EUR', layout = Layout(width = '200px'))
@@ -166,9 +193,35 @@ class DividendApp(VBox):
                                            HBox([self.widgets['stock_currency_label'],self.widgets['stock_currency']]),
                                            self.widgets['stock_btn_view']])
         
-        # Tabs to contain the 2 views
+
+        # Widgets for SX5E Screener View
+        # Labels
+        self.widgets['screen_start_label'] = Label(value = 'Start Date', layout = Layout(width = '100px'))
+        self.widgets['screen_end_label'] = Label(value = 'End Date', layout = Layout(width = '100px'))
+        self.widgets['screen_currency_label'] = Label(value = 'Currency', layout = Layout(width = '100px'))
+
+
+        # User input widgets
+        self.widgets['screen_start_dt'] = DatePicker(value = start_date, layout = Layout(width = '200px'))
+        self.widgets['screen_end_dt'] = DatePicker(value = end_date, layout = Layout(width = '200px'))
+        self.widgets['screen_currency'] = Text(value = 'EUR', layout = Layout(width = '200px'))
+
+
+        self.widgets['screen_btn'] = Button(description = 'Get Data', button_style = 'Primary')
+        self.widgets['screen_btn'].on_click(self.screener_run)
+        self.widgets['screen_btn_view'] = HBox([self.widgets['screen_btn']], layout = {'margin': '20px 0px 20px 0px'})
+
+
+        # Complete Screener View
+        self.widgets['screener_view'] = VBox([HBox([self.widgets['screen_start_label'], self.widgets['screen_start_dt']]),
+                                              HBox([self.widgets['screen_end_label'], self.widgets['screen_end_dt']]),
+                                              HBox([self.widgets['screen_currency_label'], self.widgets['screen_currency']]),
+                                              self.widgets['screen_btn_view']])
+
+        # Tabs to contain the 3 views
         tab_children = {'Index Futures' : self.widgets['index_view'],
-                        'Single Stock': self.widgets['stock_view']}        
+                        'Single Stock': self.widgets['stock_view'],
+                        'SX5E Screener': self.widgets['screener_view']}        
         tabs = Tab(children = [*tab_children.values()])
         for index,title in enumerate(tab_children.keys()):
             tabs.set_title(index,title)
@@ -180,9 +233,25 @@ class DividendApp(VBox):
 
         # Spinner for when data is loading
         self.widgets['spinner'] = HTML('''<i class="fa fa-spinner fa-spin" style="font-size:24px"></i>''')
+
+        # Changing an input cancels the run in flight for that tab
+        for key in ['idx_ticker', 'idx_start_dt', 'idx_end_dt', 'idx_mode']:
+            self.widgets[key].observe(lambda change: self.cancel_run('index'), names = 'value')
+        for key in ['stock_ticker', 'stock_start_dt', 'stock_end_dt', 'stock_currency']:
+            self.widgets[key].observe(lambda change: self.cancel_run('stock'), names = 'value')
+        for key in ['screen_start_dt', 'screen_end_dt', 'screen_currency']:
+            self.widgets[key].observe(lambda change: self.cancel_run('screener'), names = 'value')
+        
+        # Export bar - writes the DataFrames from the last run of every tab to one file
+        self.widgets['export_fmt'] = Dropdown(options = EXPORT_FORMATS, value = 'parquet', layout = Layout(width = '150px'))
+        self.widgets['export_btn'] = Button(description = 'Export', button_style = 'Info')
+        self.widgets['export_btn'].on_click(self.export_run)
+        self.widgets['export_status'] = Label(value = '')
+        self.widgets['export_view'] = HBox([self.widgets['export_fmt'], self.widgets['export_btn'], self.widgets['export_status']],
+                                           layout = {'margin': '10px 0px 10px 0px'})
         
         # Full App view
-        self.children = [VBox([app_details, tabs])]
+        self.children = [VBox([app_details, tabs, self.widgets['export_view']])]
 
 
     def read_ui(self):
@@ -194,10 +263,14 @@ class DividendApp(VBox):
         ui = {'idx_ticker' : self.widgets['idx_ticker'].value, 
               'idx_start_dt' : self.widgets['idx_start_dt'].value,
               'idx_end_dt' : self.widgets['idx_end_dt'].value, 
+              'idx_mode' : self.widgets['idx_mode'].value,
               'stock_ticker' : self.widgets['stock_ticker'].value,
               'stock_start_dt' : self.widgets['stock_start_dt'].value,
               'stock_end_dt' : self.widgets['stock_end_dt'].value,
-              'stock_currency' : self.widgets['stock_currency'].value
+              'stock_currency' : self.widgets['stock_currency'].value,
+              'screen_start_dt' : self.widgets['screen_start_dt'].value,
+              'screen_end_dt' : self.widgets['screen_end_dt'].value,
+              'screen_currency' : self.widgets['screen_currency'].value
              }
 
 
@@ -206,29 +279,57 @@ class DividendApp(VBox):
     
 ##### RUN FUNCTIONS #####
 
+    def set_busy(self, tab, busy):
+        '''
+        Show or hide the "Requesting Data..." state for the Index, Single Stock or Screener tab
+        '''
+
+        btn_keys = {'index' : ('index_button', 'idx_btn_view'),
+                    'stock' : ('stock_btn', 'stock_btn_view'),
+                    'screener' : ('screen_btn', 'screen_btn_view')}
+        btn, btn_view = [self.widgets[key] for key in btn_keys[tab]]
+
+        # Button stays enabled while busy so that a new click supersedes the run in flight
+        btn_view.children = [btn, self.widgets['spinner']] if busy else [btn]
+        btn.description = 'Requesting Data...' if busy else 'Get Data'
+        btn.button_style = 'warning' if busy else 'Primary'
+
+
+    def cancel_run(self, tab):
+        '''
+        Cancel the run in flight for a tab and discard its results - called when user inputs change
+        '''
+
+        self.runs[tab].cancel()
+        self.set_busy(tab, False)
+
+
     def index_run(self, *args):
         '''
-        Get data and update view for the Index tab
+        Start a new run for the Index tab, superseding any run still in flight
         '''
         
         # Set up startup view
-        start_view = list(self.widgets['index_view'].children)[:4]
+        start_view = list(self.widgets['index_view'].children)[:5]
         self.widgets['index_view'].children = start_view
 
         # Update view to show data is being fetched
-        self.widgets['index_view'].children = start_view
-        self.widgets['idx_btn_view'].children = [self.widgets['index_button'], self.widgets['spinner']]
-        self.widgets['index_button'].disabled = True
-        self.widgets['index_button'].description = 'Requesting Data...'
-        self.widgets['index_button'].button_style = 'warning'
+        self.set_busy('index', True)
+        run = self._index_history_run if self.read_ui()['idx_mode'] == 'history' else self._index_run
+        self.runs['index'].launch(run, start_view)
+
 
+    def _index_run(self, token, start_view):
+        '''
+        Get data and update view for the Index tab - runs in a background thread
+        '''
 
         try:
             
             # Get data
-            df = self.get_idx_fut_data()
-            oi_df = self.get_idx_open_int()
-            hist_df = self.get_idx_hist()
+            df = self.get_idx_fut_data(token)
+            oi_df = self.get_idx_open_int(token)
+            hist_df = self.get_idx_hist(token)
 
 #           # Create visualisations
             fig_curves = self.create_idx_curves(df)
@@ -237,23 +338,63 @@ class DividendApp(VBox):
             hist_chart = self.create_idx_hist_chart(hist_df)
             
             
-            self.widgets['index_view'].children = start_view + [fig_curves, fig_bar, hist_chart, oi_chart]
+            if self.runs['index'].is_current(token):
+                self.widgets['index_view'].children = start_view + [fig_curves, fig_bar, hist_chart, oi_chart]
+                self.datasets['index'] = {'index_curves' : df, 'index_open_interest' : oi_df, 'index_history' : hist_df}
+
+
+        except RunCancelled:
+            return
+
+        except Exception as e:
+            if self.runs['index'].is_current(token):
+                err_msg = HTML('''<p style="color:red;" >{error}</p>'''.format(error = str(e)))
+                self.widgets['index_view'].children = start_view + [err_msg]
+
+        # Hide spinner and reset button to initial state, unless a newer run has taken over
+        if self.runs['index'].is_current(token):
+            self.set_busy('index', False)
+
+
+    def _index_history_run(self, token, start_view):
+        '''
+        Get the daily term structure and update view for the Index tab in Term Structure History mode - runs in a background thread
+        '''
+
+        try:
+
+            # Get data - a single request, all views below are built from the same array
+            panel = self.get_idx_term_structure(token)
+
+            # Create visualisations
+            heatmap = self.create_idx_heatmap(panel)
+            curve_anim = self.create_idx_curve_animation(panel)
+            stats_grid = self.create_idx_tenor_stats(panel)
 
+            # The futures universe only lists contracts trading today, so tenors that expired within the range are missing
+            note = HTML('''<p style="text-align:center; font-style:italic">History covers the DEC contracts listed today - contracts which expired since {start} are not included</p>'''
+                        .format(start = self.read_ui()['idx_start_dt']))
+
+            if self.runs['index'].is_current(token):
+                self.widgets['index_view'].children = start_view + [note, heatmap, curve_anim, stats_grid]
+                self.datasets['index'] = {'term_structure' : pd.DataFrame(panel['values'], index = pd.DatetimeIndex(panel['dates'], name = 'DATE'), columns = panel['tenors'])}
+
+        except RunCancelled:
+            return
 
         except Exception as e:
-            err_msg = HTML('''<p style="color:red;" >{error}</p>'''.format(error = str(e)))
-            self.widgets['index_view'].children = start_view + [err_msg]
+            if self.runs['index'].is_current(token):
+                err_msg = HTML('''<p style="color:red;" >{error}</p>'''.format(error = str(e)))
+                self.widgets['index_view'].children = start_view + [err_msg]
 
-        # Hide spinner and reset button to initial state
-        self.widgets['idx_btn_view'].children = [self.widgets['index_button']]
-        self.widgets['index_button'].disabled = False
-        self.widgets['index_button'].description = 'Get Data'
-        self.widgets['index_button'].button_style = 'Primary'
+        # Hide spinner and reset button to initial state, unless a newer run has taken over
+        if self.runs['index'].is_current(token):
+            self.set_busy('index', False)
         
         
     def stock_run(self, *args):
         '''
-        Get data and update view for the Single Stock tab
+        Start a new run for the Single Stock tab, superseding any run still in flight
         '''
         
         # Set up startup view
@@ -261,47 +402,122 @@ class DividendApp(VBox):
         self.widgets['stock_view'].children = start_view
 
         # Update view to show data is being fetched
-        self.widgets['stock_view'].children = start_view
-        self.widgets['stock_btn_view'].children = [self.widgets['stock_btn'], self.widgets['spinner']]
-        self.widgets['stock_btn'].disabled = True
-        self.widgets['stock_btn'].description = 'Requesting Data...'
-        self.widgets['stock_btn'].button_style = 'warning'
+        self.set_busy('stock', True)
+        self.runs['stock'].launch(self._stock_run, start_view)
+
 
+    def _stock_run(self, token, start_view):
+        '''
+        Get data and update view for the Single Stock tab - runs in a background thread
+        '''
 
         try:
 
             # Get data
-            df1 = self.get_stock_fut_data()
-            df2 = self.get_stock_est_data()
+            df1 = self.get_stock_fut_data(token)
+            df2 = self.get_stock_est_data(token)
             df = pd.concat([df1, df2], axis=1)
             df = df.round(2)
-            df_hist = self.get_stock_div_hist()
-            price_df = self.get_stock_hist()
+            df_hist = self.get_stock_div_hist(token)
+            price_df = self.get_stock_hist(token)
 
             # Create visualisations
             fig_curves = self.create_stock_curves(df)
             fig_bar = self.create_stock_bars(df)
             hist_chart = self.create_div_hist_chart(df_hist)
             price_chart = self.create_stock_chart(price_df)
-            self.widgets['stock_view'].children = start_view + [fig_curves, fig_bar, hist_chart, price_chart]
+
+            if self.runs['stock'].is_current(token):
+                self.widgets['stock_view'].children = start_view + [fig_curves, fig_bar, hist_chart, price_chart]
+                self.datasets['stock'] = {'stock_curves' : df, 'stock_dividends' : df_hist, 'stock_history' : price_df}
+
+        except RunCancelled:
+            return
+
+        except Exception as e:
+            if self.runs['stock'].is_current(token):
+                err_msg = HTML('''<p style="color:red;" >{error}</p>'''.format(error = str(e)))
+                self.widgets['stock_view'].children = start_view + [err_msg]
+
+
+        # Hide spinner and reset button to initial state, unless a newer run has taken over
+        if self.runs['stock'].is_current(token):
+            self.set_busy('stock', False)
+
+
+    def screener_run(self, *args):
+        '''
+        Start a new run for the SX5E Screener tab, superseding any run still in flight
+        '''
+
+        # Set up startup view
+        start_view = list(self.widgets['screener_view'].children[:4])
+        self.widgets['screener_view'].children = start_view
+
+        # Update view to show data is being fetched
+        self.set_busy('screener', True)
+        self.runs['screener'].launch(self._screener_run, start_view)
+
+
+    def _screener_run(self, token, start_view):
+        '''
+        Get data and update view for the SX5E Screener tab - runs in a background thread
+        '''
+
+        try:
+
+            # Get data
+            data = self.get_screener_data(token)
+
+            # Create visualisations
+            table = self.create_screener_table(data)
+            grid = self.create_screener_grid(table)
+
+            if self.runs['screener'].is_current(token):
+                self.widgets['screener_view'].children = start_view + [grid]
+                self.datasets['screener'] = {'screener' : table}
+
+        except RunCancelled:
+            return
 
         except Exception as e:
-            err_msg = HTML('''<p style="color:red;" >{error}</p>'''.format(error = str(e)))
-            self.widgets['stock_view'].children = start_view + [err_msg]
+            if self.runs['screener'].is_current(token):
+                err_msg = HTML('''<p style="color:red;" >{error}</p>'''.format(error = str(e)))
+                self.widgets['screener_view'].children = start_view + [err_msg]
 
 
-        # Hide spinner and reset button to initial state
-        self.widgets['stock_btn_view'].children = [self.widgets['stock_btn']]
-        self.widgets['stock_btn'].disabled = False
-        self.widgets['stock_btn'].description = 'Get Data'
-        self.widgets['stock_btn'].button_style = 'Primary'
+        # Hide spinner and reset button to initial state, unless a newer run has taken over
+        if self.runs['screener'].is_current(token):
+            self.set_busy('screener', False)
+
+
+    def export_run(self, *args):
+        '''
+        Write every DataFrame from the last run of each tab to one file, in a background writer thread
+        '''
+
+        frames = {name : df for tab in self.datasets.values() for name, df in tab.items()}
+        if not frames:
+            self.widgets['export_status'].value = 'Nothing to export yet - hit Get Data first'
+            return
+
+        fmt = self.widgets['export_fmt'].value
+        self.widgets['export_btn'].disabled = True
+        self.widgets['export_status'].value = 'Exporting...'
+        export_in_background(frames, export_path('dividend_futures', fmt), fmt, on_done = self._export_done)
+
+
+    def _export_done(self, path, error):
+
+        self.widgets['export_status'].value = 'Export failed: ' + str(error) if error else 'Saved to ' + path
+        self.widgets['export_btn'].disabled = False
 
 
 
 ##### GET INDEX DATA FUNCTIONS ##############
 
 
-    def get_idx_fut_data(self):
+    def get_idx_fut_data(self, token = None):
         '''
         Pulls Index Dividend Futures data from BQL and processes response into a dataframe
         '''
@@ -321,7 +537,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(univ, fields, with_params = with_params) # Create request
-        res = bq.execute(req) # Execute request
+        res = self.execute(req, token) # Execute request
         
         
         df = pd.concat([fld.df()[fld.name] for fld in res], axis=1, sort=False) # Process response into dataframe
@@ -332,7 +548,7 @@ class DividendApp(VBox):
         return df
 
 
-    def get_idx_open_int(self):
+    def get_idx_open_int(self, token = None):
         '''
         Pulls 5Y historical aggregate open interest for the Index
         '''
@@ -349,7 +565,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(generic_ticker, field)
-        res = bq.execute(req)
+        res = self.execute(req, token)
 
 
         df = res[0].df().set_index('DATE')
@@ -358,7 +574,7 @@ class DividendApp(VBox):
         return df
     
     
-    def get_idx_hist(self):
+    def get_idx_hist(self, token = None):
         '''
         Get historical index close from start date to end date
         '''
@@ -374,7 +590,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(ticker, field)
-        res = bq.execute(req)
+        res = self.execute(req, token)
         
         
         df = res[0].df()
@@ -383,8 +599,68 @@ class DividendApp(VBox):
         
         return df            
 
+
+    def get_idx_term_structure(self, token = None):
+        '''
+        Pulls daily prices of every DEC future for the selected index over the date range in one request
+        and stores them as a compact dates x tenors float32 array, forward-filling gaps
+
+        Only contracts in today's futures chain are covered - expired tenors are not in the universe.
+        '''
+
+
+        ui = self.read_ui()
+        univ = self.bq.univ.futures(ui['idx_ticker']).filter(self.bq.data.fut_month_yr().left(3)=='DEC')
+
+
+        fields = {'Tenor' : bq.data.fut_last_trade_dt().year(),
+                  'Price' : self.bq.data.px_last(dates=self.bq.func.range(ui['idx_start_dt'], ui['idx_end_dt']))}
+
+
+        req = bql.Request(univ, fields, with_params = {'mode' : 'cached'})
+        res = self.execute(req, token)
+
+
+        tenor_df = res[0].df()
+        price_df = res[1].df()
+        tenor_by_fut = tenor_df['Tenor'] # One tenor per future, mapped onto its daily prices below
+
+
+        dates = np.sort(pd.to_datetime(price_df['DATE']).unique())
+        tenors = np.sort(pd.to_numeric(tenor_by_fut, errors='coerce').dropna().unique()).astype(int)
+
+
+        values = self.to_matrix(pd.to_datetime(price_df['DATE']).values,
+                                tenor_by_fut.reindex(price_df.index).values,
+                                price_df['Price'].values,
+                                dates, tenors).astype(np.float32)
+
+
+        panel = {'index' : ui['idx_ticker'],
+                 'dates' : dates,
+                 'tenors' : tenors,
+                 'values' : self.ffill(values)}
+
+
+        return panel
+
+
+    @staticmethod
+    def ffill(values):
+        '''
+        Forward-fills NaN gaps down each column of a 2D array - leading gaps stay NaN
+        '''
+
+
+        rows = np.arange(values.shape[0])[:, None]
+        last_valid = np.where(np.isnan(values), 0, rows)
+        np.maximum.accumulate(last_valid, axis=0, out=last_valid)
+
+
+        return values[last_valid, np.arange(values.shape[1])]
+
     
-    def get_idx_implied_points(self):
+    def get_idx_implied_points(self, token = None):
         '''
         Calculates bottom-up index points from single-stock broker estimates - not implemented
         '''
@@ -406,7 +682,7 @@ class DividendApp(VBox):
         fields = [shares / divisor * bq.data.is_div_per_shr(fpt='a', fpr=str(year), currency='EUR').znav() for year in years]
         
         req = bql.Request(univ, fields)
-        res = bq.execute(req)
+        res = self.execute(req, token)
         
         
         df = pd.concat([fld.df()[fld.name] for fld in res], axis = 1, sort = False)
@@ -565,12 +841,127 @@ class DividendApp(VBox):
         return fig
 
 
+    def create_idx_heatmap(self, panel):
+        '''
+        Create heatmap of the daily term structure (tenors x dates) from get_idx_term_structure()
+        '''
+
+
+        app_settings = self.get_model_settings()
+        index_lookup = {item: key for key, item in app_settings['index_info'].items()}
+
+
+        traces = go.Heatmap(x = panel['dates'],
+                            y = panel['tenors'],
+                            z = panel['values'].T,
+                            colorscale = 'Teal')
+
+
+        fig = go.FigureWidget(data = traces,
+                              layout = {'template' : 'plotly_dark',
+                                        'title' : {'text' : index_lookup[panel['index']] + ' Dividend Futures Term Structure (Index Points)'},
+                                        'title_x' : 0.5,
+                                        'height' : 450,
+                                        'margin' : {'l':20, 'r':20, 't':50, 'b':50}})
+
+
+        fig.update_layout(plot_bgcolor = 'rgba(33,33,33,33)',
+                          paper_bgcolor = 'rgba(33,33,33,33)')
+        fig.update_yaxes(dtick=1)
+
+
+        return fig
+
+
+    def create_idx_curve_animation(self, panel):
+        '''
+        Create dividend curve chart with a play button stepping through each date of the term structure
+        '''
+
+
+        app_settings = self.get_model_settings()
+        index_lookup = {item: key for key, item in app_settings['index_info'].items()}
+        dates = pd.to_datetime(panel['dates']).strftime('%Y-%m-%d')
+
+
+        # First date kept as a reference curve, second trace is updated by the slider
+        traces = [go.Scatter(x = panel['tenors'], y = panel['values'][0], name = dates[0]),
+                  go.Scatter(x = panel['tenors'], y = panel['values'][-1], name = dates[-1])]
+
+
+        fig = go.FigureWidget(data = traces, layout = {'template' : 'plotly_dark',
+                                                       'margin' : {'l':20, 'r':20, 't':50, 'b':20},
+                                                       'colorway' : ['LightBlue', 'Teal'],
+                                                       'title' : {'text' : index_lookup[panel['index']] + ' Dividend Curve (Index Points)'},
+                                                       'title_x' : 0.5})
+
+
+        fig.update_layout(legend_x = 0.01,
+                          legend_y = -0.05,
+                          legend = dict(orientation='h'),
+                          yaxis_range = [np.nanmin(panel['values']) * 0.95, np.nanmax(panel['values']) * 1.05],
+                          plot_bgcolor='rgba(33,33,33,33)',
+                          paper_bgcolor='rgba(33,33,33,33)')
+        fig.update_xaxes(dtick=1)
+
+
+        play = Play(min = 0, max = len(dates) - 1, value = len(dates) - 1, interval = 100)
+        slider = IntSlider(min = 0, max = len(dates) - 1, value = len(dates) - 1, readout = False, layout = Layout(width = '500px'))
+        date_label = Label(value = dates[-1])
+        jslink((play, 'value'), (slider, 'value'))
+
+
+        def update_curve(change):
+            with fig.batch_update():
+                fig.data[1].y = panel['values'][change['new']]
+                fig.data[1].name = dates[change['new']]
+            date_label.value = dates[change['new']]
+
+        slider.observe(update_curve, names = 'value')
+
+
+        return VBox([fig, HBox([play, slider, date_label])])
+
+
+    def create_idx_tenor_stats(self, panel):
+        '''
+        Create grid of per-tenor change statistics over the date range
+        '''
+
+
+        values = panel['values'].astype(float)
+        cols = np.arange(values.shape[1])
+        first = values[np.argmax(~np.isnan(values), axis=0), cols] # First valid price of each tenor
+        last = values[-1]
+        daily_chg = np.diff(values, axis=0)
+
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats = {'Start' : first,
+                     'End' : last,
+                     'Net Change' : last - first,
+                     '% Change' : (last / first - 1) * 100,
+                     'Min' : np.nanmin(values, axis=0),
+                     'Max' : np.nanmax(values, axis=0),
+                     'Daily Chg Std' : np.nanstd(daily_chg, axis=0) if len(daily_chg) else np.full(len(cols), np.nan)}
+
+
+        df = pd.DataFrame(stats, index = panel['tenors']).round(2)
+        df.index.name = 'Tenor'
+
+
+        grid = ipdg.DataGrid(df, base_column_size = 100, layout = {'height' : '300px'})
+
+
+        return grid
+
+
 
     
 
 ##### SINGLE STOCK GET DATA FUNCTIONS
 
-    def get_stock_fut_data(self):
+    def get_stock_fut_data(self, token = None):
         '''
         Pulls dividend futures data for selected ticker and dates
         '''
@@ -600,7 +991,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(univ, fields, with_params = with_params)
-        res = bq.execute(req)
+        res = self.execute(req, token)
 
 
         df = pd.concat([fld.df()[fld.name] for fld in res], axis=1, sort=False)
@@ -611,7 +1002,7 @@ class DividendApp(VBox):
         return df   
 
 
-    def get_stock_est_data(self):
+    def get_stock_est_data(self, token = None):
         '''
         Pulls broker estimates for dividend per share from current year (N) to N+5
         '''
@@ -630,7 +1021,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(ui['stock_ticker'], fields, with_params=with_params)
-        res = bq.execute(req)
+        res = self.execute(req, token)
 
 
         df = pd.concat([fld.df()[fld.name] for fld in res], axis=1, sort=False)
@@ -641,7 +1032,7 @@ class DividendApp(VBox):
         return df
 
 
-    def get_stock_div_hist(self):
+    def get_stock_div_hist(self, token = None):
         '''
         Pulls annual dividends for the past 20 years 
         '''
@@ -661,7 +1052,7 @@ class DividendApp(VBox):
 
 
         req = bql.Request(ui['stock_ticker'], field, with_params = with_params)
-        res = bq.execute(req)
+        res = self.execute(req, token)
 
 
         df = pd.concat([fld.df()[fld.name] for fld in res], axis=1, sort=False)
@@ -671,7 +1062,7 @@ class DividendApp(VBox):
         return df
     
     
-    def get_stock_hist(self):
+    def get_stock_hist(self, token = None):
         '''
         Pulls daily closing price from start date to end date for Single Stock
         '''
@@ -688,7 +1079,7 @@ class DividendApp(VBox):
         
         
         req = bql.Request(ui['stock_ticker'], field, with_params = with_params)
-        res = bq.execute(req)
+        res = self.execute(req, token)
         
         
         df = res[0].df()
@@ -723,7 +1114,7 @@ class DividendApp(VBox):
                                                        'height' : 450,
                                                        'colorway' : colours,
                                                        'title' : 
-                                                       {'text' : self.get_idx_members()[ui['stock_ticker']] + ' Dividend Futures vs Consensus (' + ui['stock_currency'] + ')'},
+                                                       {'text' : self.idx_members[ui['stock_ticker']] + ' Dividend Futures vs Consensus (' + ui['stock_currency'] + ')'},
                                                         'title_x' : 0.5})
         
         
@@ -789,7 +1180,7 @@ class DividendApp(VBox):
                               layout = {'template' : 'plotly_dark',
                                         'colorway' : ['#919191'],
                                         'title' : 
-                                        {'text' : self.get_idx_members()[ui['stock_ticker']] + ' Historical Dividends - Annual - 25Y (' + ui['stock_currency'] + ')'},
+                                        {'text' : self.idx_members[ui['stock_ticker']] + ' Historical Dividends - Annual - 25Y (' + ui['stock_currency'] + ')'},
                                         'title_x' : 0.5})
         
         
@@ -818,7 +1209,7 @@ class DividendApp(VBox):
                               layout = {'template' : 'plotly_dark',
                                         'colorway' : ['Teal'],
                                         'title' : 
-                                        {'text' : self.get_idx_members()[ui['stock_ticker']] + ' Historical Closing Price (' + ui['stock_currency'] + ')'},
+                                        {'text' : self.idx_members[ui['stock_ticker']] + ' Historical Closing Price (' + ui['stock_currency'] + ')'},
                                         'title_x' : 0.5,
                                         'height' : 350,
                                         'legend_y' : -0.2,
@@ -831,4 +1222,142 @@ class DividendApp(VBox):
 
         return fig
 
-    
+
+
+##### SX5E SCREENER GET DATA FUNCTIONS
+
+    def get_screener_data(self, token = None):
+        '''
+        Pulls DEC single-stock dividend futures and broker DPS estimates for every SX5E member in two batched
+        requests and arranges them as members x years matrices with the futures-minus-consensus spread
+        '''
+
+
+        ui = self.read_ui()
+        members = list(self.idx_members.keys())
+        year = ui['screen_start_dt'].year
+        years = np.arange(year, year + 6) # Current year (N) to N+5, as in get_stock_est_data()
+
+
+        with_params = {'fill' : 'prev',
+                       'mode' : 'cached',
+                       'currency' : ui['screen_currency']}
+
+
+        # Futures for all members at once, using the same filters as get_stock_fut_data()
+        filters = {'exch' : bq.data.exch_code()=='GR',
+                   'sec_typ' : bq.data.security_typ()=='SINGLE STOCK DIVIDEND FUTURE',
+                   'month' : bq.data.fut_last_trade_dt().month()==12,
+                   }
+
+        univ = bq.univ.futures(members).filter(filters['exch'].and_(filters['sec_typ']).and_(filters['month']))
+
+        fields = {'Year' : bq.data.fut_last_trade_dt().year(),
+                  'Start' : bq.data.px_settle(dates=ui['screen_start_dt']),
+                  'End' : bq.data.px_last(dates=ui['screen_end_dt'])}
+
+
+        req = bql.Request(univ, fields, with_params = with_params)
+        res = self.execute(req, token, priority = BATCH) # Universe-wide - queued behind interactive requests
+
+
+        fut_df = pd.concat([fld.df()[fld.name] for fld in res], axis=1, sort=False)
+        fut_df['Member'] = res[0].df()['ORIG_IDS'] # Member ticker each future was expanded from
+
+
+        # Broker estimates for all members at once
+        est_fields = {'Start' : self.bq.data.is_div_per_shr(as_of_date=ui['screen_start_dt'], fpt='a', fpr=self.bq.func.range(year, year+5)),
+                      'End' : self.bq.data.is_div_per_shr(as_of_date=ui['screen_end_dt'], fpt='a', fpr=self.bq.func.range(year, year+5))}
+
+
+        req = bql.Request(self.bq.univ.list(members), est_fields, with_params = {'fill' : 'prev', 'currency' : ui['screen_currency']})
+        res = self.execute(req, token, priority = BATCH) # Universe-wide - queued behind interactive requests
+
+
+        # Each field is placed by its own (ID, PERIOD_END_DATE) rows, so a period missing for one date cannot shift the other
+        est = {}
+        for fld in res:
+            df = fld.df()
+            est[fld.name] = self.to_matrix(df.index.values, pd.to_datetime(df['PERIOD_END_DATE']).dt.year.values, df[fld.name].values, members, years)
+
+
+        data = {'members' : members,
+                'years' : years,
+                'fut_start' : self.to_matrix(fut_df['Member'].values, fut_df['Year'].values, fut_df['Start'].values, members, years),
+                'fut_end' : self.to_matrix(fut_df['Member'].values, fut_df['Year'].values, fut_df['End'].values, members, years),
+                'est_start' : est['Start'],
+                'est_end' : est['End']}
+
+
+        data['spread_start'] = data['fut_start'] - data['est_start']
+        data['spread_end'] = data['fut_end'] - data['est_end']
+        data['spread_chg'] = data['spread_end'] - data['spread_start']
+
+
+        return data
+
+
+    @staticmethod
+    def to_matrix(row_ids, col_ids, values, row_labels, col_labels):
+        '''
+        Scatters long-format values into a row_labels x col_labels matrix, averaging duplicates (e.g. companies
+        with more than one active dividend future per year) - missing cells are NaN
+        '''
+
+
+        row_pos = pd.Index(row_labels).get_indexer(row_ids)
+        col_pos = pd.Index(col_labels).get_indexer(pd.to_numeric(col_ids, errors='coerce'))
+        values = pd.to_numeric(values, errors='coerce').astype(float)
+
+        keep = (row_pos >= 0) & (col_pos >= 0) & ~np.isnan(values)
+
+        sums = np.zeros((len(row_labels), len(col_labels)))
+        counts = np.zeros_like(sums)
+        np.add.at(sums, (row_pos[keep], col_pos[keep]), values[keep])
+        np.add.at(counts, (row_pos[keep], col_pos[keep]), 1)
+
+
+        with np.errstate(invalid='ignore'):
+            return sums / counts
+
+
+
+##### SX5E SCREENER VISUALISATION FUNCTIONS
+
+
+    def create_screener_table(self, data):
+        '''
+        Lay out futures-minus-consensus spread and its change between start and end date, per member and year
+        '''
+
+
+        columns = {'Ticker' : data['members']}
+        for i, year in enumerate(data['years']):
+            columns[str(year) + ' Spread'] = data['spread_end'][:, i]
+            columns[str(year) + ' Chg'] = data['spread_chg'][:, i]
+
+
+        df = pd.DataFrame(columns, index = [self.idx_members[ticker] for ticker in data['members']]).round(2)
+        df.index.name = 'Name'
+
+
+        return df
+
+
+    def create_screener_grid(self, df):
+        '''
+        Create sortable grid from the screener table
+        '''
+
+
+        ui = self.read_ui()
+
+
+        title = HTML('''<p style="text-align:center; font-weight:bold">SX5E Dividend Futures minus Consensus ({ccy}) - {end} and change since {start}</p>'''
+                     .format(ccy = ui['screen_currency'], end = ui['screen_end_dt'], start = ui['screen_start_dt']))
+
+        grid = ipdg.DataGrid(df, base_column_size = 90, base_row_header_size = 200, layout = {'height' : '600px'})
+
+
+        return VBox([title, grid])
+
@@ -0,0 +1,4 @@
+from .runs import CancelToken, RunGuard, RunCancelled, RequestTimeout, execute
+from .scheduler import RequestScheduler, get_scheduler, INTERACTIVE, BACKGROUND, BATCH
+from .cache import CachedService, CacheServer, CacheClient
+from .export import export_frames, export_in_background, export_path, FORMATS as EXPORT_FORMATS
@@ -0,0 +1,392 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import pyarrow as pa
+except ImportError: # Cache is optional - without pyarrow requests go straight to BQL
+    pa = None
+
+from .scheduler import request_key
+
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.bqnt_cache.sock')
+
+# Time-to-live (seconds) of cached responses
+DEFAULT_TTL = 300           # Latest data, or any date range reaching today
+HISTORICAL_TTL = 24 * 3600  # Data for fixed dates that are all in the past
+UNIVERSE_TTL = 24 * 3600    # Index members and issuer bond universes are refreshed daily
+
+_UNIVERSE_FUNCS = ('members(', 'bonds(')
+_FOR_CLAUSE = re.compile(r'\bfor\s*\(')
+_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+_RELATIVE_DATE = re.compile(r'(?<![\w.])-?\d+[dwmqy]\b', re.IGNORECASE) # e.g. 0d, -5y
+
+
+def default_freshness(key, default_ttl = DEFAULT_TTL):
+    '''
+    Time-to-live for a BQL query string - the shortest one implied by its universe and its dates
+
+    Data without dates, with relative dates or with a date from today onwards gets default_ttl, data for fixed
+    past dates HISTORICAL_TTL - dates in the universe are ignored. An index membership or bond universe caps it at UNIVERSE_TTL.
+    '''
+
+    # Split the for(...) clause from the rest (get and with clauses) by matching its brackets
+    universe, data = '', key
+    match = _FOR_CLAUSE.search(key)
+    if match:
+        depth, end = 1, match.end()
+        while end < len(key) and depth:
+            depth += {'(': 1, ')': -1}.get(key[end], 0)
+            end += 1
+        universe, data = key[match.end():end], key[:match.start()] + key[end:]
+
+    dates = _DATE.findall(data)
+    historical = bool(dates) and max(dates) < datetime.date.today().isoformat() and not _RELATIVE_DATE.search(data)
+    ttl = HISTORICAL_TTL if historical else default_ttl
+
+    if any(func in universe for func in _UNIVERSE_FUNCS):
+        ttl = min(ttl, UNIVERSE_TTL)
+
+    return ttl
+
+
+##### WIRE PROTOCOL
+# Each message is a JSON header and an opaque payload, both length-prefixed
+
+def _recv_exact(sock, size):
+
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('Cache connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def _send_msg(sock, header, payload = b''):
+
+    header = json.dumps(header).encode()
+    sock.sendall(struct.pack('>IQ', len(header), len(payload)) + header)
+    if payload:
+        sock.sendall(payload)
+
+
+def _recv_msg(sock):
+
+    header_len, payload_len = struct.unpack('>IQ', _recv_exact(sock, 12))
+    header = json.loads(_recv_exact(sock, header_len))
+    payload = _recv_exact(sock, payload_len) if payload_len else b''
+
+    return header, payload
+
+
+##### SERVER
+
+class CacheStore():
+    '''
+    Size-bounded LRU store of opaque payloads, each with its own expiry time
+    '''
+
+    def __init__(self, max_bytes = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+        self._entries = OrderedDict() # key -> (meta, payload, expires_at)
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[2] < time.time():
+                self._remove(key)
+                self.counters['expired'] += 1
+                entry = None
+
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+
+            return entry[0], entry[1]
+
+
+    def put(self, key, meta, payload, ttl):
+
+        if len(payload) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (meta, payload, time.time() + ttl)
+            self.size += len(payload)
+
+            # Evict least recently used entries until back under the size limit
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.counters['evictions'] += 1
+
+
+    def stats(self):
+
+        with self._lock:
+            return dict(self.counters, entries = len(self._entries), bytes = self.size, max_bytes = self.max_bytes)
+
+
+    def _remove(self, key):
+
+        meta, payload, expires_at = self._entries.pop(key)
+        self.size -= len(payload)
+
+
+class _CacheHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+
+        store = self.server.store
+
+        while True:
+            try:
+                header, payload = _recv_msg(self.request)
+            except ConnectionError:
+                return
+
+            if header['op'] == 'get':
+                entry = store.get(header['key'])
+                if entry is None:
+                    _send_msg(self.request, {'hit': False})
+                else:
+                    _send_msg(self.request, {'hit': True, 'meta': entry[0]}, entry[1])
+
+            elif header['op'] == 'put':
+                store.put(header['key'], header['meta'], payload, header['ttl'])
+                _send_msg(self.request, {'ok': True})
+
+            elif header['op'] == 'stats':
+                _send_msg(self.request, store.stats())
+
+            else:
+                _send_msg(self.request, {'error': 'Unknown op ' + str(header['op'])})
+
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Local cache daemon shared by every notebook kernel on the machine, listening on a Unix socket
+
+    It never talks to BQL itself, so it can be run and tested without a Terminal connection.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path = DEFAULT_SOCKET, max_bytes = 512 * 2**20):
+
+        if os.path.exists(path):
+            if CacheClient(path).stats() is not None:
+                raise RuntimeError('A cache daemon is already listening on ' + path)
+            os.remove(path) # Stale socket from a previous daemon
+
+        self.path = path
+        self.store = CacheStore(max_bytes)
+        super().__init__(path, _CacheHandler)
+
+
+    def start(self):
+        '''
+        Serves in a background thread - useful as a stand-in inside a single kernel
+        '''
+
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+        return self
+
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+##### CLIENT
+
+class CacheClient():
+    '''
+    Talks to the cache daemon - every failure is treated as a miss so the apps keep working without it
+    '''
+
+    def __init__(self, path = DEFAULT_SOCKET, timeout = 2):
+        self.path = path
+        self.timeout = timeout
+
+
+    def _call(self, header, payload = b''):
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            _send_msg(sock, header, payload)
+
+            return _recv_msg(sock)
+
+
+    def get(self, key):
+
+        try:
+            header, payload = self._call({'op': 'get', 'key': key})
+        except (OSError, ConnectionError, ValueError):
+            return None
+
+        return (header['meta'], payload) if header.get('hit') else None
+
+
+    def put(self, key, meta, payload, ttl):
+
+        try:
+            self._call({'op': 'put', 'key': key, 'meta': meta, 'ttl': ttl}, payload)
+        except (OSError, ConnectionError, ValueError):
+            pass
+
+
+    def stats(self):
+
+        try:
+            return self._call({'op': 'stats'})[0]
+        except (OSError, ConnectionError, ValueError):
+            return None
+
+
+##### BQL SERVICE WRAPPER
+
+class CachedItem():
+    '''
+    Stands in for a BQL response item: exposes .name and .df() like the items of bq.execute()
+    '''
+
+    def __init__(self, name, df):
+        self.name = name
+        self._df = df
+
+
+    def df(self):
+        return self._df
+
+
+def encode_response(res):
+    '''
+    Serialises each item of a BQL response as an Arrow IPC stream, concatenated into one payload
+    '''
+
+    parts, buffers = [], []
+    for item in res:
+        table = pa.Table.from_pandas(item.df(), preserve_index = True)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        buf = sink.getvalue()
+
+        parts.append({'name': item.name, 'size': buf.size})
+        buffers.append(buf.to_pybytes())
+
+    return {'parts': parts}, b''.join(buffers)
+
+
+def decode_response(meta, payload):
+    '''
+    Rebuilds response items from the Arrow buffers without copying the payload
+    '''
+
+    buf = pa.py_buffer(payload)
+    items, offset = [], 0
+    for part in meta['parts']:
+        table = pa.ipc.open_stream(buf.slice(offset, part['size'])).read_all()
+        items.append(CachedItem(part['name'], table.to_pandas()))
+        offset += part['size']
+
+    return items
+
+
+class CachedService():
+    '''
+    Wraps a bql.Service so that execute() checks the shared cache daemon first
+
+    Everything else (data, univ, func...) is passed through, so it can be handed to any app in place of bq.
+    '''
+
+    def __init__(self, bq, path = DEFAULT_SOCKET, freshness = default_freshness, default_ttl = DEFAULT_TTL):
+        self._bq = bq
+        self.client = CacheClient(path)
+        self.freshness = freshness
+        self.default_ttl = default_ttl
+
+
+    def __getattr__(self, name):
+        return getattr(self._bq, name)
+
+
+    def ttl(self, key):
+        '''
+        Time-to-live for a request, from the freshness function (key, default_ttl) -> seconds
+        '''
+
+        return self.freshness(key, self.default_ttl)
+
+
+    def execute(self, req):
+
+        if pa is None or not os.path.exists(self.client.path):
+            return self._bq.execute(req) # No daemon running - go straight to BQL
+
+        key = request_key(req)
+        cached = self.client.get(key)
+        if cached is not None:
+            return decode_response(*cached)
+
+        res = self._bq.execute(req)
+
+        try:
+            meta, payload = encode_response(res)
+        except (pa.ArrowException, TypeError, ValueError):
+            return res # Not representable in Arrow - serve it uncached
+
+        self.client.put(key, meta, payload, self.ttl(key))
+
+        return res
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Local BQL response cache shared by notebook kernels')
+    parser.add_argument('--socket', default = DEFAULT_SOCKET)
+    parser.add_argument('--max-mb', type = int, default = 512)
+    args = parser.parse_args()
+
+    server = CacheServer(args.socket, max_bytes = args.max_mb * 2**20)
+    print('BQL cache listening on ' + args.socket)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
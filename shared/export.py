@@ -0,0 +1,180 @@
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet export needs pyarrow - xlsx export still works without it
+    pa = pq = None
+
+
+FORMATS = {'Parquet' : 'parquet',
+           'Excel (slower)' : 'xlsx'}
+
+
+def export_path(app_name, fmt):
+    '''
+    Default export name, e.g. dividend_futures_20240131_1530.xlsx - a Parquet export is a folder of that name
+    '''
+
+    name = '{}_{}'.format(app_name, datetime.now().strftime('%Y%m%d_%H%M'))
+
+    return name if fmt == 'parquet' else name + '.' + fmt
+
+
+def _chunks(frame, chunk_rows):
+    '''
+    Yields a dataset in chunks - DataFrames are sliced, iterables of DataFrames are streamed as they come
+
+    A callable returning such an iterable can be given instead, so a stored dataset can be exported more than once.
+    '''
+
+    if callable(frame):
+        frame = frame()
+
+    if isinstance(frame, pd.DataFrame):
+        for start in range(0, max(len(frame), 1), chunk_rows):
+            yield frame.iloc[start:start + chunk_rows]
+    else:
+        yield from frame
+
+
+def _to_table(chunk):
+
+    df = chunk.reset_index()
+    df.columns = [str(col) for col in df.columns]
+
+    return pa.Table.from_pandas(df, preserve_index = False).replace_schema_metadata()
+
+
+def _merge_type(left, right):
+    '''
+    Type for a column whose chunks disagree - only ever widens: ints to floats, anything else to strings
+    '''
+
+    if left == right or pa.types.is_null(right):
+        return left
+    if pa.types.is_null(left):
+        return right
+    if (pa.types.is_integer(left) or pa.types.is_floating(left)) and (pa.types.is_integer(right) or pa.types.is_floating(right)):
+        return pa.float64()
+
+    return pa.string()
+
+
+def _conform(table, schema):
+    '''
+    Adds missing columns as nulls and widens the rest so a chunk matches its dataset's schema
+    '''
+
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            col = table.column(field.name)
+            columns.append(col if col.type == field.type else col.cast(field.type))
+        else:
+            columns.append(pa.nulls(len(table), field.type))
+
+    return pa.Table.from_arrays(columns, schema = schema)
+
+
+def _write_dataset(frame, path, chunk_rows):
+    '''
+    Writes one dataset to its own Parquet file, one row group per chunk
+
+    A DataFrame is converted in one go so its schema is exact. Streamed chunks are spooled to temporary
+    files first, so the schema can be widened to fit every chunk before the file is written.
+    '''
+
+    if isinstance(frame, pd.DataFrame):
+        pq.write_table(_to_table(frame), path, row_group_size = chunk_rows, compression = 'zstd')
+        return
+
+    with tempfile.TemporaryDirectory(dir = os.path.dirname(path) or None) as spool:
+        parts, fields = [], {}
+        for i, chunk in enumerate(_chunks(frame, chunk_rows)):
+            table = _to_table(chunk)
+            for field in table.schema:
+                fields[field.name] = _merge_type(fields[field.name], field.type) if field.name in fields else field.type
+
+            parts.append(os.path.join(spool, '{}.parquet'.format(i)))
+            pq.write_table(table, parts[-1])
+
+        schema = pa.schema([pa.field(name, pa.string() if pa.types.is_null(typ) else typ) for name, typ in fields.items()])
+
+        with pq.ParquetWriter(path, schema, compression = 'zstd') as writer:
+            for part in parts:
+                writer.write_table(_conform(pq.read_table(part), schema))
+
+
+def write_parquet(frames, path, chunk_rows = 100000):
+    '''
+    Writes every dataset to its own Parquet file (<dataset>.parquet) in the folder path, each with its own schema
+    '''
+
+    os.makedirs(path, exist_ok = True)
+
+    for name, frame in frames.items():
+        _write_dataset(frame() if callable(frame) else frame, os.path.join(path, name + '.parquet'), chunk_rows)
+
+    return path
+
+
+def write_xlsx(frames, path, chunk_rows = 100000):
+    '''
+    Writes every dataset to one Excel workbook, one sheet per dataset, appending chunk by chunk
+
+    Columns are placed by name: a column first seen in a later chunk is added to the right, and the header row
+    is written last, once every column of the dataset is known.
+    '''
+
+    with pd.ExcelWriter(path) as writer:
+        for name, frame in frames.items():
+            columns, row = [], 1
+            for chunk in _chunks(frame, chunk_rows):
+                df = chunk.reset_index()
+                df.columns = [str(col) for col in df.columns]
+                columns += [col for col in df.columns if col not in columns]
+
+                df.reindex(columns = columns).to_excel(writer, sheet_name = name[:31], startrow = row, header = False, index = False)
+                row += len(df)
+
+            pd.DataFrame(columns = columns).to_excel(writer, sheet_name = name[:31], index = False)
+
+    return path
+
+
+def export_frames(frames, path, fmt = 'parquet', chunk_rows = 100000):
+
+    if fmt == 'parquet':
+        if pq is None:
+            raise ImportError('pyarrow is required for Parquet export')
+        return write_parquet(frames, path, chunk_rows)
+
+    return write_xlsx(frames, path, chunk_rows)
+
+
+def export_in_background(frames, path, fmt = 'parquet', on_done = None, chunk_rows = 100000):
+    '''
+    Runs export_frames in a background writer thread so the UI stays usable
+
+    on_done(path, error) is called from the writer thread when the file is complete or has failed.
+    '''
+
+    def target():
+        error = None
+        try:
+            export_frames(frames, path, fmt, chunk_rows)
+        except Exception as e:
+            error = e
+        if on_done is not None:
+            on_done(path, error)
+
+    thread = threading.Thread(target = target, daemon = True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,180 @@
+import threading
+from concurrent import futures
+
+from .scheduler import INTERACTIVE
+
+
+class RunCancelled(Exception):
+    '''
+    Raised inside a run once a newer run (or an input change) has superseded it
+    '''
+
+
+class RequestTimeout(Exception):
+    '''
+    Raised when a BQL request does not return within its timeout
+    '''
+
+
+# Errors worth retrying - anything else (bad query, missing field...) would fail the same way again
+TRANSIENT_ERRORS = (RequestTimeout, ConnectionError, TimeoutError)
+
+
+class CancelToken():
+    '''
+    Cancellation flag shared by every request made during a single run
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+
+
+    def cancel(self):
+        self._event.set()
+
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+    def check(self):
+        '''
+        Raises RunCancelled if the run has been superseded
+        '''
+
+        if self.cancelled:
+            raise RunCancelled()
+
+
+    def wait(self, seconds):
+        '''
+        Sleeps for up to `seconds`, returning True early if the run is cancelled
+        '''
+
+        return self._event.wait(seconds)
+
+
+class RunGuard():
+    '''
+    Latest-wins bookkeeping for a run handler: starting a run cancels the one in flight
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None
+
+
+    def start(self):
+        '''
+        Cancels the in-flight run (if any) and returns the token for a new one
+        '''
+
+        with self._lock:
+            if self._current is not None:
+                self._current.cancel()
+            self._current = CancelToken()
+
+            return self._current
+
+
+    def cancel(self):
+        '''
+        Cancels the in-flight run without starting a new one
+        '''
+
+        with self._lock:
+            if self._current is not None:
+                self._current.cancel()
+            self._current = None
+
+
+    def is_current(self, token):
+        '''
+        True if results from the run owning `token` should still be rendered
+        '''
+
+        with self._lock:
+            return token is self._current and not token.cancelled
+
+
+    def launch(self, target, *args):
+        '''
+        Starts a new run of `target(token, *args)` in a background thread and returns its token
+        '''
+
+        token = self.start()
+        threading.Thread(target = target, args = (token, *args), daemon = True).start()
+
+        return token
+
+
+def execute(bq, req, token = None, timeout = 60, retries = 2, backoff = 1.0, priority = INTERACTIVE):
+    '''
+    Executes a BQL request with a timeout and bounded retries, honouring the run's cancel token
+
+    Each attempt runs in its own daemon thread so a hung bq.execute cannot block the caller.
+    When bq is a RequestScheduler, the request is queued with the given priority.
+    Timeouts and connection errors are retried after backoff * 2 ** attempt seconds, other errors are raised at once.
+    '''
+
+    token = token or CancelToken()
+
+    for attempt in range(retries + 1):
+        token.check()
+
+        try:
+            res = _execute_once(bq, req, token, timeout, priority)
+            token.check() # Discard late results if the run was superseded while waiting
+            return res
+
+        except TRANSIENT_ERRORS:
+            if attempt == retries:
+                raise
+            if token.wait(backoff * 2 ** attempt):
+                raise RunCancelled()
+
+
+def _execute_once(bq, req, token, timeout, priority):
+    '''
+    Runs bq.execute in a daemon thread and waits for it in short slices so cancellation is noticed
+
+    A RequestScheduler is submitted to directly instead, and the request is withdrawn from it on timeout
+    or cancellation, so the scheduler can drop it or stop counting it against its concurrency cap.
+    The timeout then only counts once the request has left the queue.
+    '''
+
+    if hasattr(bq, 'withdraw'):
+        future, withdraw = bq.submit(req, priority), bq.withdraw
+        job = future.job
+    else:
+        future, withdraw = futures.Future(), lambda future, timed_out = False: None
+        job = None
+
+        def target():
+            try:
+                future.set_result(bq.execute(req))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target = target, daemon = True).start()
+
+    waited = 0.0
+    while not future.done():
+        futures.wait([future], 0.1)
+        if future.done():
+            break
+
+        if token.cancelled:
+            withdraw(future)
+            raise RunCancelled()
+
+        if job is not None and job.started_at is None:
+            continue # Still queued behind the concurrency cap
+
+        waited += 0.1
+        if timeout is not None and waited >= timeout:
+            withdraw(future, timed_out = True)
+            raise RequestTimeout('BQL request timed out after {} seconds'.format(timeout))
+
+    return future.result()
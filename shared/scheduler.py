@@ -0,0 +1,260 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+# Request priorities - lower values are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+BATCH = 2
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BATCH: 'batch'}
+
+
+def request_key(req):
+    '''
+    Identifies a BQL request so that identical requests in flight can share one response
+    '''
+
+    to_string = getattr(req, 'to_string', None)
+
+    return to_string() if callable(to_string) else repr(req)
+
+
+class _Job():
+
+    def __init__(self, bq, key, req, priority):
+        self.bq = bq
+        self.key = key
+        self.req = req
+        self.priority = priority
+        self.callers = 1
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.timed_out = False # A caller gave up on it - never merge new callers onto it
+        self.released = False  # No longer counted against the concurrency cap
+        self.future = Future()
+        self.future.job = self
+
+
+class RequestScheduler():
+    '''
+    Runs BQL requests for every app in the kernel through one priority queue with a concurrency cap
+
+    Exposes execute(req) like bql.Service, and submit/withdraw so shared.execute can give up on a request
+    (timeout or cancelled run) without a hung request holding one of the slots forever.
+    '''
+
+    def __init__(self, bq, max_concurrent = 4, history = 1000):
+        self.bq = bq
+        self.max_concurrent = max_concurrent
+        self.metrics = deque(maxlen = history) # Most recent completed requests
+        self._cond = threading.Condition()
+        self._queue = []
+        self._in_flight = {} # Queued or running jobs new callers can merge onto, by (service, request key)
+        self._running = 0    # Jobs counted against the concurrency cap
+        self._seq = itertools.count()
+
+
+    def submit(self, req, priority = INTERACTIVE, bq = None):
+        '''
+        Queues a request to be run with bq (the scheduler's own service by default) and returns a Future for its response
+
+        If an identical request for the same service is already queued or running, its Future is returned instead,
+        and a queued request is promoted if the new caller has a higher priority.
+        '''
+
+        bq = self.bq if bq is None else bq
+        key = request_key(req)
+
+        with self._cond:
+            job = self._in_flight.get((id(bq), key))
+
+            if job is not None:
+                job.callers += 1
+                if job.started_at is None and priority < job.priority:
+                    job.priority = priority
+                    heapq.heappush(self._queue, (priority, next(self._seq), job))
+
+                return job.future
+
+            job = _Job(bq, key, req, priority)
+            self._in_flight[(id(bq), key)] = job
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._dispatch()
+
+            return job.future
+
+
+    def withdraw(self, future, timed_out = False):
+        '''
+        Gives up on a submitted request
+
+        A queued request nobody is waiting for any more is dropped. A request that timed out stops accepting
+        new callers, so a retry gets a fresh request, and once nobody waits for it, it no longer counts
+        against the concurrency cap even if bq.execute never returns.
+        '''
+
+        job = future.job
+
+        with self._cond:
+            if job.future.done():
+                return
+
+            job.callers -= 1
+            if timed_out:
+                job.timed_out = True
+                self._forget(job)
+
+            if job.callers > 0:
+                return
+
+            if job.started_at is None:
+                self._forget(job)
+                job.future.cancel() # Stale queue entry is skipped by _dispatch
+            elif job.timed_out and not job.released:
+                job.released = True
+                self._running -= 1
+                self._dispatch()
+
+
+    def execute(self, req, priority = INTERACTIVE, bq = None):
+        '''
+        Submits a request and blocks until its response is available
+        '''
+
+        return self.submit(req, priority, bq).result()
+
+
+    def queue_length(self):
+
+        with self._cond:
+            return sum(1 for job in self._in_flight.values() if job.started_at is None)
+
+
+    def stats(self):
+        '''
+        Summarises queue-wait and service-time metrics (in seconds) by priority
+        '''
+
+        with self._cond:
+            metrics = list(self.metrics)
+
+        summary = {}
+        for name in PRIORITY_NAMES.values():
+            rows = [row for row in metrics if row['priority'] == name]
+            if not rows:
+                continue
+
+            waits = [row['queue_wait'] for row in rows]
+            services = [row['service_time'] for row in rows]
+            summary[name] = {'requests': len(rows),
+                             'merged callers': sum(row['callers'] - 1 for row in rows),
+                             'errors': sum(1 for row in rows if row['error']),
+                             'avg queue wait': sum(waits) / len(rows),
+                             'max queue wait': max(waits),
+                             'avg service time': sum(services) / len(rows),
+                             'max service time': max(services)}
+
+        return summary
+
+
+    def _forget(self, job):
+
+        if self._in_flight.get((id(job.bq), job.key)) is job:
+            del self._in_flight[(id(job.bq), job.key)]
+
+
+    def _dispatch(self):
+        '''
+        Starts queued jobs while under the concurrency cap, skipping entries left behind by promotions and withdrawals
+        Must be called with the lock held.
+        '''
+
+        while self._queue and self._running < self.max_concurrent:
+            priority, _, job = heapq.heappop(self._queue)
+            if job.started_at is not None or priority != job.priority or job.future.cancelled():
+                continue
+
+            job.started_at = time.monotonic()
+            self._running += 1
+            threading.Thread(target = self._run, args = (job,), daemon = True).start()
+
+
+    def _run(self, job):
+
+        error = None
+        try:
+            res = job.bq.execute(job.req)
+        except Exception as e:
+            error = e
+        finished_at = time.monotonic()
+
+        with self._cond:
+            self._forget(job)
+            if not job.released:
+                job.released = True
+                self._running -= 1
+                self._dispatch()
+
+            self.metrics.append({'request': job.key,
+                                 'priority': PRIORITY_NAMES.get(job.priority, str(job.priority)),
+                                 'callers': job.callers,
+                                 'queue_wait': job.started_at - job.queued_at,
+                                 'service_time': finished_at - job.started_at,
+                                 'timed_out': job.timed_out,
+                                 'error': None if error is None else str(error)})
+
+        if error is None:
+            job.future.set_result(res)
+        else:
+            job.future.set_exception(error)
+
+
+class _BoundScheduler():
+    '''
+    The kernel-wide scheduler as seen by one app: requests are queued with everyone else's but run with the app's own service
+    '''
+
+    def __init__(self, scheduler, bq):
+        self.scheduler = scheduler
+        self.bq = bq
+
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+
+    def submit(self, req, priority = INTERACTIVE):
+        return self.scheduler.submit(req, priority, self.bq)
+
+
+    def execute(self, req, priority = INTERACTIVE):
+        return self.scheduler.execute(req, priority, self.bq)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(bq, max_concurrent = None):
+    '''
+    Returns the kernel-wide scheduler bound to bq, creating the scheduler on first use (with 4 concurrent requests unless given)
+
+    Every app in the kernel shares the same queue, so the concurrency cap applies globally, while each app's
+    requests still run with the service it was built with. Asking for another cap raises rather than being ignored.
+    '''
+
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(bq, max_concurrent = max_concurrent or 4)
+
+        elif max_concurrent is not None and max_concurrent != _scheduler.max_concurrent:
+            raise ValueError('The kernel-wide scheduler already runs with max_concurrent = {}'.format(_scheduler.max_concurrent))
+
+        return _BoundScheduler(_scheduler, bq)